@@ -46,6 +46,13 @@ The Grapple constructor accepts the following keyword arguments:
 
     genesis (int):
         Genesis ledger index and download halting point. (default=152370)
+
+    start_date, end_date (str, datetime or int):
+        Only download ledgers that closed in [start_date, end_date).  Either
+        can be given as a date string, a datetime or a Unix timestamp.  The
+        matching ledger indexes are found by binary search over ledger close
+        times; probed close times are kept in the ledger_close_times table
+        and reused by later searches. (default=None)
     
     quiet (bool):
         If True, suppress console output. (default=True)
@@ -54,6 +61,39 @@ The Grapple constructor accepts the following keyword arguments:
         Resampling frequencies, using pandas frequency codes.  If None, then
         resampling is disabled. (default=('D',) or daily)
 
+    fetch_workers (int):
+        Number of threads fetching ledgers and transactions from rippled.
+        Each fetcher opens its own websocket. (default=1)
+
+    parse_workers (int):
+        Number of threads parsing transactions into trade records. (default=1)
+
+    write_workers (int):
+        Number of threads inserting trade records into Postgres.  Each writer
+        opens its own database connection. (default=1)
+
+    queue_size (int):
+        Maximum depth of the queues between the fetch, parse and write
+        stages.  A full queue blocks the stage feeding it. (default=1000)
+
+    summary_window (int):
+        Length in seconds of the rolling window used for the volume, VWAP
+        and trade count columns of the market_summary table. (default=86400)
+
+    summary_flush_size (int):
+        Number of stored trades between market_summary flushes.
+        (default=1000)
+
+    retention_days (int):
+        Days of raw trades to keep in ripple_ledger, counting back from the
+        newest trade.  Older trades that are already covered by
+        resampled_ledger bars are moved to compressed columnar archive files
+        after each download.  If None, compaction is disabled.  Archives are
+        deleted when a new download drops ripple_ledger. (default=None)
+
+    archive_dir (str):
+        Directory for archive files. (default="archive")
+
 Usage as a script:
 
     python grapple.py [-flags]
@@ -72,9 +112,21 @@ Optional flags:
     -g, --genesis [ledger index]:
         Genesis ledger index and download halting point.
 
+    -s, --start-date [date]:
+        Only download ledgers that closed on or after this date.
+
+    -e, --end-date [date]:
+        Only download ledgers that closed before this date.
+
     -q, --quiet:
         Suppress command line output.
 
+    -r, --retention [days]:
+        Archive raw trades older than this many days.
+
+    --fetchers [count], --parsers [count], --writers [count]:
+        Number of fetch, parse and write worker threads.
+
 """
 from __future__ import division, print_function, unicode_literals, absolute_import
 import sys
@@ -84,8 +136,12 @@ try:
 except:
     pass
 import os
+import binascii
 import getopt
+import heapq
 import json
+import numbers
+import threading
 import websocket
 from decimal import Decimal, getcontext, ROUND_HALF_EVEN
 from contextlib import contextmanager
@@ -97,6 +153,7 @@ import psycopg2.extensions as ext
 
 # Python 3 compatibility
 from six.moves import xrange as range
+from six.moves import queue
 _IS_PYTHON_3 = sys.version_info[0] == 3
 identity = lambda x : x
 if _IS_PYTHON_3:
@@ -115,10 +172,31 @@ if not os.environ.get("CONTINUOUS_INTEGRATION"):
     conn = db.connect(POSTGRES_CONNECTION_STRING)
     conn.set_isolation_level(ext.ISOLATION_LEVEL_READ_COMMITTED)
 
+# Raw trades with dimension keys resolved, as stored in archive files
+TRADES_QUERY = (
+    "SELECT r.txid, upper(encode(r.txhash, 'hex')) AS txhash, "
+    "r.currency1, r.currency2, r.amount1, r.amount2, r.price1, r.price2, "
+    "i1.address AS issuer1, i2.address AS issuer2, a.address AS account1, "
+    "r.txdate, r.ledgerindex, r.accepted "
+    "FROM ripple_ledger r "
+    "LEFT JOIN ledger_issuers i1 ON r.issuer1 = i1.issuerid "
+    "LEFT JOIN ledger_issuers i2 ON r.issuer2 = i2.issuerid "
+    "LEFT JOIN ledger_accounts a ON r.account1 = a.accountid"
+)
+ARCHIVE_COLUMNS = ('txid', 'txhash', 'currency1', 'currency2', 'amount1',
+                   'amount2', 'price1', 'price2', 'issuer1', 'issuer2',
+                   'account1', 'txdate', 'ledgerindex', 'accepted')
+ARCHIVE_INTEGER_COLUMNS = ('txid', 'txdate', 'ledgerindex')
+ARCHIVE_DECIMAL_COLUMNS = ('amount1', 'amount2', 'price1', 'price2')
+
 class Grapple(object):
 
     def __init__(self, socket_url="ws://127.0.0.1:6006/", full=False,
-                 genesis=152370, quiet=True, resampling_frequencies=('D',)):
+                 genesis=152370, quiet=True, resampling_frequencies=('D',),
+                 fetch_workers=1, parse_workers=1, write_workers=1,
+                 queue_size=1000, summary_window=86400,
+                 summary_flush_size=1000, start_date=None, end_date=None,
+                 retention_days=None, archive_dir="archive"):
         """
         Args:
           socket_url (str): rippled websocket URL (default="ws://127.0.0.1:6006/")
@@ -134,11 +212,42 @@ class Grapple(object):
                                           frequency codes.  If None, then
                                           resampling is disabled.
                                           (default=('D',) or daily)
+          fetch_workers (int): Number of ledger/transaction fetcher threads,
+                               each with its own websocket. (default=1)
+          parse_workers (int): Number of transaction parser threads.
+                               (default=1)
+          write_workers (int): Number of database writer threads, each with
+                               its own Postgres connection. (default=1)
+          queue_size (int): Maximum depth of each inter-stage queue.
+                            (default=1000)
+          summary_window (int): Rolling window length (in seconds) for
+                                market_summary. (default=86400)
+          summary_flush_size (int): Trades stored between market_summary
+                                    flushes. (default=1000)
+          start_date (str, datetime or int): Earliest ledger close time to
+                                             download. (default=None)
+          end_date (str, datetime or int): Download only ledgers that closed
+                                           before this time. (default=None)
+          retention_days (int): Days of raw trades kept in ripple_ledger.
+                                If None, compaction is disabled.
+                                (default=None)
+          archive_dir (str): Directory for archived raw trades.
+                             (default="archive")
 
         """
+        for name, value in (('fetch_workers', fetch_workers),
+                            ('parse_workers', parse_workers),
+                            ('write_workers', write_workers),
+                            ('queue_size', queue_size)):
+            if value < 1:
+                raise ValueError("%s must be at least 1, got %r" % (name, value))
         self.full = full
         self.socket_url = socket_url
-        self.start_date = None
+        self.start_date = start_date
+        self.end_date = end_date
+        self.close_times = {}
+        self.retention_days = retention_days
+        self.archive_dir = archive_dir
         self.halt = genesis
         self.socket = None
         self.ledger_current_index = None
@@ -147,6 +256,24 @@ class Grapple(object):
         self.markets = []
         self.quiet = quiet
         self.resampling_frequencies = resampling_frequencies
+        self.fetch_workers = fetch_workers
+        self.parse_workers = parse_workers
+        self.write_workers = write_workers
+        self.queue_size = queue_size
+        self.queue_stats = {}
+        self.worker_errors = []
+        self.stored_tx = 0
+        self.summary_window = summary_window
+        self.summary_flush_size = summary_flush_size
+        self.market_windows = {}
+        self.summary_pending = set()
+        self.summary_updates = 0
+        self.market_ids = InternCache("ledger_markets", "marketid",
+                                      ("currency1", "currency2"))
+        self.issuer_ids = InternCache("ledger_issuers", "issuerid", ("address",))
+        self.account_ids = InternCache("ledger_accounts", "accountid", ("address",))
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
 
     def get_current_index(self, retry=False):
         try:
@@ -167,28 +294,40 @@ class Grapple(object):
                 return
             self.get_current_index(retry=True)
 
-    def get_tx(self, tx_hash, data):
+    def get_tx(self, tx_hash, data, socket=None):
         try:
-            if self.socket is not None:
-                self.socket.send(json.dumps({
-                    'command': 'tx',
-                    'transaction': tx_hash,
-                }))
-                tx_data = self.socket.recv()
-                tx_data = json.loads(tx_data)
-                if tx_data['status'] == 'success' and 'result' in tx_data:
-                    options = {
-                        'ledger_time': data['result']['ledger']['close_time'],
-                        'tx_hash': tx_hash,
-                    }
-                    return tx_data['result'], options
+            return self.request_tx(tx_hash, data, socket)
         except Exception as exc:
             if not self.quiet:
                 print(exc)
         return False, False
 
+    def request_tx(self, tx_hash, data, socket=None):
+        """Like get_tx, but socket errors and malformed replies are raised."""
+        if socket is None:
+            socket = self.socket
+        if socket is not None:
+            socket.send(json.dumps({
+                'command': 'tx',
+                'transaction': tx_hash,
+            }))
+            tx_data = socket.recv()
+            tx_data = json.loads(tx_data)
+            if tx_data['status'] == 'success' and 'result' in tx_data:
+                options = {
+                    'ledger_time': data['result']['ledger']['close_time'],
+                    'tx_hash': tx_hash,
+                }
+                return tx_data['result'], options
+        return False, False
+
     def parse_tx(self, tx, accepted, ledger_time=None, tx_hash=None):
-        stored_tx_count = 0
+        records = self.build_records(tx, accepted, ledger_time, tx_hash)
+        return self.write_records(records)
+
+    def build_records(self, tx, accepted, ledger_time=None, tx_hash=None):
+        """Extract ripple_ledger rows from an executed offer transaction."""
+        records = []
         if tx['TransactionType'] == 'Payment' and 'meta' in tx and tx['meta']['TransactionResult'] == 'tesSUCCESS':
             for affected_node in tx['meta']['AffectedNodes']:
                 if 'ModifiedNode' in affected_node:
@@ -242,44 +381,166 @@ class Grapple(object):
                         gets['price'] = (pays['amount'] / gets['amount']).quantize(gets['quantum'])
                         pays['amount'] = pays['amount'].quantize(pays['quantum'])
                         gets['amount'] = gets['amount'].quantize(gets['quantum'])
-                        try:
-                            with cursor() as cur:
-                                txdate = None if ledger_time is None else ledger_time + RIPPLE_EPOCH
-                                records = {
-                                    'txid': tx['meta']['TransactionIndex'],
-                                    'txhash': tx_hash,
-                                    'market': pays['currency'] + gets['currency'],
-                                    'currency1': pays['currency'],
-                                    'currency2': gets['currency'],
-                                    'amount1': pays['amount'],
-                                    'amount2': gets['amount'],
-                                    'price1': pays['price'],
-                                    'price2': gets['price'],
-                                    'issuer1': pays['issuer'],
-                                    'issuer2': gets['issuer'],
-                                    'account1': final['Account'],
-                                    'txdate': txdate,
-                                    'ledgerindex': tx['ledger_index'],
-                                    'accepted': accepted,
-                                }
-                                sql = (
-                                    "INSERT INTO ripple_ledger "
-                                    "(txid, txhash, market, currency1, currency2, amount1, amount2, "
-                                    "price1, price2, issuer1, issuer2, account1, "
-                                    "txdate, ledgerindex, accepted, collected) "
-                                    "VALUES "
-                                    "(%(txid)s, %(txhash)s, %(market)s, %(currency1)s, %(currency2)s, "
-                                    "%(amount1)s, %(amount2)s, %(price1)s, %(price2)s, "
-                                    "%(issuer1)s, %(issuer2)s, %(account1)s, "
-                                    "%(txdate)s, %(ledgerindex)s, %(accepted)s, now())"
-                                )
-                                cur.execute(sql, records)
-                                stored_tx_count += 1
-                        except Exception as exc:
-                            if not self.quiet:
-                                print(exc)
+                        txdate = None if ledger_time is None else ledger_time + RIPPLE_EPOCH
+                        records.append({
+                            'txid': tx['meta']['TransactionIndex'],
+                            'txhash': tx_hash,
+                            'currency1': pays['currency'],
+                            'currency2': gets['currency'],
+                            'amount1': pays['amount'],
+                            'amount2': gets['amount'],
+                            'price1': pays['price'],
+                            'price2': gets['price'],
+                            'issuer1': pays['issuer'],
+                            'issuer2': gets['issuer'],
+                            'account1': final['Account'],
+                            'txdate': txdate,
+                            'ledgerindex': tx['ledger_index'],
+                            'accepted': accepted,
+                        })
+        return records
+
+    def encode_record(self, record, connection=None):
+        """Swap a record's strings for surrogate keys and a binary hash."""
+        row = dict(record)
+        row['txhash'] = encode_txhash(record['txhash'])
+        row['marketid'] = self.market_ids.resolve((record['currency1'],
+                                                   record['currency2']),
+                                                  connection)
+        row['issuer1'] = self.issuer_ids.resolve(record['issuer1'], connection)
+        row['issuer2'] = self.issuer_ids.resolve(record['issuer2'], connection)
+        row['account1'] = self.account_ids.resolve(record['account1'], connection)
+        return row
+
+    def write_records(self, records, connection=None):
+        stored_tx_count = 0
+        sql = (
+            "INSERT INTO ripple_ledger "
+            "(txid, txhash, marketid, currency1, currency2, amount1, amount2, "
+            "price1, price2, issuer1, issuer2, account1, "
+            "txdate, ledgerindex, accepted, collected) "
+            "VALUES "
+            "(%(txid)s, %(txhash)s, %(marketid)s, %(currency1)s, %(currency2)s, "
+            "%(amount1)s, %(amount2)s, %(price1)s, %(price2)s, "
+            "%(issuer1)s, %(issuer2)s, %(account1)s, "
+            "%(txdate)s, %(ledgerindex)s, %(accepted)s, now())"
+        )
+        stored = []
+        for record in records:
+            try:
+                row = self.encode_record(record, connection)
+                with cursor(connection) as cur:
+                    cur.execute(sql, row)
+                    stored.append(record)
+                    stored_tx_count += 1
+            except Exception as exc:
+                if not self.quiet:
+                    print(exc)
+        if stored:
+            self.update_market_summary(stored, connection)
         return stored_tx_count
 
+    def update_market_summary(self, records, connection=None):
+        """Add stored trades to the in-memory market windows.
+
+        Markets touched since the last flush are written to market_summary
+        once summary_flush_size trades have accumulated.
+
+        """
+        with self._lock:
+            for record in records:
+                market = (record['currency1'], record['currency2'])
+                if market not in self.market_windows:
+                    self.market_windows[market] = MarketWindow(self.summary_window)
+                self.market_windows[market].add(record)
+                self.summary_pending.add(market)
+            self.summary_updates += len(records)
+            flush = self.summary_updates >= self.summary_flush_size
+        if flush:
+            self.flush_market_summary(connection)
+
+    def reset_market_summary(self):
+        """Forget the in-memory market windows, e.g. after market_summary
+        has been dropped."""
+        with self._lock:
+            self.market_windows = {}
+            self.summary_pending = set()
+            self.summary_updates = 0
+
+    def flush_market_summary(self, connection=None):
+        """Write pending market windows to the market_summary table.
+
+        Errors are logged rather than raised, and the markets that were
+        being flushed stay pending for the next attempt.
+
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending = self.summary_pending
+                rows = [self.market_windows[market].row(market)
+                        for market in pending]
+                self.summary_pending = set()
+                self.summary_updates = 0
+            if not rows:
+                return
+            update = (
+                "UPDATE market_summary SET "
+                "lasttxdate = %(lasttxdate)s, lastprice1 = %(lastprice1)s, "
+                "lastprice2 = %(lastprice2)s, volume1 = %(volume1)s, "
+                "volume2 = %(volume2)s, vwap1 = %(vwap1)s, vwap2 = %(vwap2)s, "
+                "windowtrades = %(windowtrades)s, tradecount = %(tradecount)s, "
+                "updated = now() "
+                "WHERE currency1 = %(currency1)s AND currency2 = %(currency2)s"
+            )
+            insert = (
+                "INSERT INTO market_summary "
+                "(currency1, currency2, lasttxdate, lastprice1, lastprice2, "
+                "volume1, volume2, vwap1, vwap2, windowtrades, tradecount, "
+                "updated) "
+                "VALUES "
+                "(%(currency1)s, %(currency2)s, %(lasttxdate)s, "
+                "%(lastprice1)s, %(lastprice2)s, %(volume1)s, %(volume2)s, "
+                "%(vwap1)s, %(vwap2)s, %(windowtrades)s, %(tradecount)s, "
+                "now())"
+            )
+            try:
+                with cursor(connection) as cur:
+                    for row in rows:
+                        cur.execute(update, row)
+                        if not cur.rowcount:
+                            cur.execute(insert, row)
+            except Exception as exc:
+                if not self.quiet:
+                    print("Error flushing market_summary", exc)
+                with self._lock:
+                    self.summary_pending |= pending
+
+    def market_summary(self, currency1=None, currency2=None):
+        """Ticker-style market summaries.
+
+        Reads last price, rolling volume, VWAP and trade counts from the
+        market_summary table, which has one row per market.
+
+        Args:
+          currency1 (str): Only include markets with this base currency.
+          currency2 (str): Only include markets with this quote currency.
+
+        Returns:
+          pandas DataFrame with one row per market.
+
+        """
+        query = "SELECT * FROM market_summary"
+        conditions, params = [], []
+        if currency1 is not None:
+            conditions.append("currency1 = %s")
+            params.append(currency1)
+        if currency2 is not None:
+            conditions.append("currency2 = %s")
+            params.append(currency2)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        return psql.frame_query(query, conn, params=params)
+
     def parse_ledger(self, data):
         accepted = False
         tx_hash_list = None
@@ -291,34 +552,43 @@ class Grapple(object):
                 accepted = True
         return tx_hash_list, accepted
 
-    def read_next_ledger(self):
-        if self.socket is not None:
-            self.socket.send(json.dumps({
+    def read_next_ledger(self, ledger_index=None, socket=None):
+        if ledger_index is None:
+            ledger_index = self.ledger_index
+        if socket is None:
+            socket = self.socket
+        if socket is not None:
+            socket.send(json.dumps({
                 'command': 'ledger',
-                'ledger_index': self.ledger_index,
+                'ledger_index': ledger_index,
                 'transactions': True,
                 'expand': False,
             }))
-            ledger = self.socket.recv()
+            ledger = socket.recv()
             return json.loads(ledger)
     
     def rippled_connect(self):
-        for i in range(5):
+        self.socket = self.open_socket()
+        return self.socket is not None
+
+    def open_socket(self, attempts=5):
+        """Open a websocket to rippled, or return None if every attempt fails."""
+        for i in range(attempts):
             try:
-                self.socket = websocket.create_connection(self.socket_url)
+                socket = websocket.create_connection(self.socket_url)
                 if not self.quiet:
                     print("Connected to", self.socket_url, "(attempt", str(i+1) + ")")
-                return True
-            except ValueError as e:
+                return socket
+            except Exception as e:
                 if not self.quiet:
                     print("Error connecting to rippled", e)
-        return False
+        return None
 
     def is_duplicate(self, tx_hash):
         duplicate = False
         with cursor() as cur:
             query = "SELECT count(*) FROM ripple_ledger WHERE txhash = %s"
-            cur.execute(query, (tx_hash,))
+            cur.execute(query, (encode_txhash(tx_hash),))
             for row in cur:
                 duplicate = row[0]
         return duplicate
@@ -359,7 +629,7 @@ class Grapple(object):
             self.updates += 1
 
     def find_markets(self):
-        query = "SELECT DISTINCT currency1, currency2 FROM ripple_ledger"
+        query = "SELECT currency1, currency2 FROM ledger_markets"
         with cursor() as cur:
             cur.execute(query)
             for row in cur:
@@ -392,9 +662,9 @@ class Grapple(object):
                     query = (
                         "SELECT currency1, currency2, price1, price2, "
                         "amount1, amount2, txdate FROM ripple_ledger "
-                        "WHERE market = '%s' "
+                        "WHERE marketid = %d "
                         "ORDER BY txdate"
-                    ) % (market[0] + market[1])
+                    ) % self.market_ids.resolve(market)
 
                 # Resample transactions from the last resampling
                 # starting timestamp or newer
@@ -402,9 +672,9 @@ class Grapple(object):
                     query = (
                         "SELECT currency1, currency2, price1, price2, "
                         "amount1, amount2, txdate FROM ripple_ledger "
-                        "WHERE market = '%s' AND txdate >= '%s' "
+                        "WHERE marketid = %d AND txdate >= '%s' "
                         "ORDER BY txdate"
-                    ) % (market[0] + market[1], last_resample)
+                    ) % (self.market_ids.resolve(market), last_resample)
                 df = psql.frame_query(query, conn)
                 if not df.empty:
                     for f in self.resampling_frequencies:
@@ -434,6 +704,10 @@ class Grapple(object):
         queries = (
             "DROP TABLE IF EXISTS ripple_ledger CASCADE",
             "DROP TABLE IF EXISTS resampled_ledger CASCADE",
+            "DROP TABLE IF EXISTS market_summary CASCADE",
+            "DROP TABLE IF EXISTS ledger_markets CASCADE",
+            "DROP TABLE IF EXISTS ledger_issuers CASCADE",
+            "DROP TABLE IF EXISTS ledger_accounts CASCADE",
             (
                 "CREATE TABLE resampled_ledger ("
                 "starttime bigint,"
@@ -452,32 +726,194 @@ class Grapple(object):
                 "volume2 numeric(24,8),"
                 "price1 numeric(24,8),"
                 "price2 numeric(24,8))"
+            ), (
+                "CREATE TABLE ledger_markets ("
+                "marketid serial NOT NULL PRIMARY KEY,"
+                "currency1 varchar(10),"
+                "currency2 varchar(10),"
+                "UNIQUE (currency1, currency2))"
+            ), (
+                "CREATE TABLE ledger_issuers ("
+                "issuerid serial NOT NULL PRIMARY KEY,"
+                "address varchar(40) UNIQUE)"
+            ), (
+                "CREATE TABLE ledger_accounts ("
+                "accountid serial NOT NULL PRIMARY KEY,"
+                "address varchar(40) UNIQUE)"
             ), (
                 "CREATE TABLE ripple_ledger ("
                 "internalid bigserial NOT NULL PRIMARY KEY,"
                 "txid bigint,"
-                "txhash varchar(1000),"
-                "market varchar(20),"
+                "txhash bytea CHECK (octet_length(txhash) = 32),"
+                "marketid integer REFERENCES ledger_markets,"
                 "currency1 varchar(10),"
                 "currency2 varchar(10),"
                 "price1 numeric(24,8),"
                 "price2 numeric(24,8),"
                 "amount1 numeric(24,8),"
                 "amount2 numeric(24,8),"
-                "issuer1 varchar(1000),"
-                "issuer2 varchar(1000),"
-                "account1 varchar(1000),"
-                "account2 varchar(1000),"
+                "issuer1 integer REFERENCES ledger_issuers,"
+                "issuer2 integer REFERENCES ledger_issuers,"
+                "account1 integer REFERENCES ledger_accounts,"
+                "account2 integer REFERENCES ledger_accounts,"
                 "txdate bigint,"
                 "ledgerindex bigint,"
                 "accepted boolean,"
                 "collected timestamp DEFAULT statement_timestamp())"
             ),
+            "CREATE INDEX idx_ripple_ledger_txhash ON ripple_ledger(txhash)",
+            "CREATE INDEX idx_ripple_ledger_ledgerindex ON ripple_ledger(ledgerindex)",
+            (
+                "CREATE TABLE market_summary ("
+                "currency1 varchar(10),"
+                "currency2 varchar(10),"
+                "lasttxdate bigint,"
+                "lastprice1 numeric(24,8),"
+                "lastprice2 numeric(24,8),"
+                "volume1 numeric(24,8),"
+                "volume2 numeric(24,8),"
+                "vwap1 numeric(24,8),"
+                "vwap2 numeric(24,8),"
+                "windowtrades bigint,"
+                "tradecount bigint,"
+                "updated timestamp,"
+                "PRIMARY KEY (currency1, currency2))"
+            ), (
+                "CREATE TABLE IF NOT EXISTS ledger_archive ("
+                "archiveid serial NOT NULL PRIMARY KEY,"
+                "path varchar(1000),"
+                "firstledger bigint,"
+                "lastledger bigint,"
+                "firsttxdate bigint,"
+                "lasttxdate bigint,"
+                "rows bigint,"
+                "archived timestamp DEFAULT statement_timestamp())"
+            ),
         )
         with cursor() as cur:
             for query in queries:
                 cur.execute(query)
                 conn.commit()
+        for cache in (self.market_ids, self.issuer_ids, self.account_ids):
+            cache.clear()
+        self.reset_market_summary()
+        self.remove_archives()
+
+    def remove_archives(self):
+        """Delete archive files along with their ledger_archive entries.
+
+        Archived trades belong to the ripple_ledger that housekeeping drops,
+        so they go with it rather than being left unreachable on disk.
+
+        """
+        with cursor() as cur:
+            cur.execute("SELECT path FROM ledger_archive")
+            paths = [row[0] for row in cur]
+            cur.execute("DELETE FROM ledger_archive")
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def load_close_times(self):
+        """Load previously probed ledger close times."""
+        with cursor() as cur:
+            cur.execute(
+                "CREATE TABLE IF NOT EXISTS ledger_close_times ("
+                "ledgerindex bigint NOT NULL PRIMARY KEY,"
+                "closetime bigint)"
+            )
+            cur.execute("SELECT ledgerindex, closetime FROM ledger_close_times")
+            for row in cur:
+                self.close_times[row[0]] = row[1]
+
+    def get_close_time(self, ledger_index, attempts=3):
+        """Unix close time of a ledger, or None if rippled doesn't have it.
+
+        Close times are looked up in self.close_times first; new probes are
+        saved to the ledger_close_times table unless another process has
+        already saved them.  Only rippled's lgrNotFound reply means the
+        ledger is missing.  Socket errors are retried on a fresh socket up to
+        attempts times and then raised, as are unexpected replies.
+
+        """
+        if ledger_index in self.close_times:
+            return self.close_times[ledger_index]
+        for attempt in range(attempts):
+            try:
+                self.socket.send(json.dumps({
+                    'command': 'ledger',
+                    'ledger_index': ledger_index,
+                    'transactions': False,
+                    'expand': False,
+                }))
+                data = json.loads(self.socket.recv())
+                break
+            except Exception as exc:
+                if not self.quiet:
+                    print("Error probing ledger", ledger_index, exc)
+                if attempt == attempts - 1:
+                    raise
+                close_socket(self.socket)
+                self.socket = self.open_socket()
+                if self.socket is None:
+                    raise IOError("lost connection to rippled")
+        if data.get('error') == 'lgrNotFound':
+            return None
+        try:
+            close_time = data['result']['ledger']['close_time'] + RIPPLE_EPOCH
+        except (KeyError, TypeError):
+            raise IOError("unexpected reply for ledger %d: %s" % (ledger_index, data))
+        self.close_times[ledger_index] = close_time
+        try:
+            with cursor() as cur:
+                cur.execute(
+                    "INSERT INTO ledger_close_times (ledgerindex, closetime) "
+                    "SELECT %s, %s WHERE NOT EXISTS ("
+                    "SELECT 1 FROM ledger_close_times WHERE ledgerindex = %s)",
+                    (ledger_index, close_time, ledger_index)
+                )
+        except Exception as exc:
+            if not self.quiet:
+                print(exc)
+        return close_time
+
+    def find_ledger_index(self, timestamp, lo, hi):
+        """Binary search for the first ledger in [lo, hi] closing at or after
+        timestamp.  Returns hi + 1 if every ledger in range closed earlier.
+
+        Cached close times narrow the search before rippled is probed.
+        Ledgers that rippled reports as not found are treated as closing
+        before timestamp, since a node's missing history is normally its
+        oldest.
+
+        """
+        hi += 1
+        for ledger_index, close_time in self.close_times.items():
+            if close_time < timestamp and lo <= ledger_index < hi:
+                lo = ledger_index + 1
+            elif close_time >= timestamp and lo <= ledger_index < hi:
+                hi = ledger_index
+        while lo < hi:
+            mid = (lo + hi) // 2
+            close_time = self.get_close_time(mid)
+            if close_time is None or close_time < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def find_date_range(self):
+        """Narrow the ledger range to the start_date/end_date window."""
+        self.load_close_times()
+        top = self.ledger_current_index - 1
+        if self.start_date is not None:
+            start = self.find_ledger_index(to_timestamp(self.start_date),
+                                           self.halt, top)
+            self.halt = max(self.halt, start)
+        if self.end_date is not None:
+            end = self.find_ledger_index(to_timestamp(self.end_date),
+                                         self.halt, top)
+            self.ledger_current_index = end
 
     def find_target_ledger(self):
         with cursor() as cur:
@@ -487,47 +923,363 @@ class Grapple(object):
             if max_ledgerindex is not None:
                 self.halt = int(max_ledgerindex)
 
+    def next_ledger_index(self):
+        """Claim the next ledger index for a fetcher, or None when done."""
+        with self._lock:
+            if self.ledger_index < self.halt:
+                return None
+            ledger_index = self.ledger_index
+            self.ledger_index -= 1
+            return ledger_index
+
+    def enqueue(self, name, q, item):
+        """Put an item on a bounded queue, recording its depth."""
+        blocked = q.full()
+        q.put(item)
+        depth = q.qsize()
+        with self._lock:
+            stats = self.queue_stats.setdefault(name, {
+                'puts': 0,
+                'blocked': 0,
+                'max_depth': 0,
+                'mean_depth': 0,
+            })
+            stats['puts'] += 1
+            stats['blocked'] += int(blocked)
+            stats['max_depth'] = max(stats['max_depth'], depth)
+            stats['mean_depth'] += (depth - stats['mean_depth']) / stats['puts']
+
+    def report_progress(self):
+        with self._lock:
+            self.ledgers_read += 1
+            if not self.quiet:
+                progress = round(float(self.ledgers_read) / float(self.ledgers_to_read), 3)
+                sys.stdout.write("Read " + str(self.ledgers_read) + "/" +\
+                                 str(self.ledgers_to_read) + " [" +\
+                                 str(progress * 100) + "%] ledgers (" +\
+                                 str(self.stored_tx) + " transactions)\r")
+                sys.stdout.flush()
+
+    def fetch_ledger(self, ledger_index, socket):
+        """Fetch a ledger's transactions as items for the parse stage.
+
+        Socket errors and malformed replies are raised, so that a ledger is
+        either fetched completely or not at all.
+
+        """
+        items = []
+        ledger = self.read_next_ledger(ledger_index, socket)
+        if ledger is not None:
+            tx_hash_list, accepted = self.parse_ledger(ledger)
+            if tx_hash_list is not None:
+                for tx_hash in tx_hash_list:
+                    if not self.full and ledger_index == self.halt:
+                        if self.is_duplicate(tx_hash):
+                            continue
+                    tx_data_result, options = self.request_tx(tx_hash, ledger, socket)
+                    if tx_data_result:
+                        items.append((tx_data_result, accepted, options))
+        return items
+
+    def fetch_worker(self, tx_queue, attempts=3):
+        """Fetch stage: read ledgers and their transactions from rippled.
+
+        A ledger that fails is retried on a fresh socket up to attempts
+        times, then recorded in worker_errors.
+
+        """
+        socket = self.open_socket()
+        if socket is None:
+            return
+        try:
+            while True:
+                ledger_index = self.next_ledger_index()
+                if ledger_index is None:
+                    break
+                items = None
+                for attempt in range(attempts):
+                    try:
+                        items = self.fetch_ledger(ledger_index, socket)
+                        break
+                    except Exception as exc:
+                        if not self.quiet:
+                            print("Error fetching ledger", ledger_index, exc)
+                        close_socket(socket)
+                        socket = self.open_socket()
+                        if socket is None:
+                            break
+                if items is None:
+                    with self._lock:
+                        self.worker_errors.append(IOError(
+                            "ledger %d could not be fetched" % ledger_index))
+                    if socket is None:
+                        raise IOError("lost connection to rippled")
+                    continue
+                for item in items:
+                    self.enqueue('tx', tx_queue, item)
+                self.report_progress()
+        finally:
+            if socket is not None:
+                close_socket(socket)
+
+    def parse_worker(self, tx_queue, record_queue):
+        """Parse stage: turn transactions into ripple_ledger records."""
+        while True:
+            item = tx_queue.get()
+            if item is None:
+                break
+            tx, accepted, options = item
+            try:
+                records = self.build_records(tx, accepted, **options)
+            except Exception as exc:
+                if not self.quiet:
+                    print(exc)
+                continue
+            if records:
+                self.enqueue('records', record_queue, records)
+
+    def write_worker(self, record_queue, connection):
+        """Write stage: insert records using a dedicated connection."""
+        try:
+            while True:
+                records = record_queue.get()
+                if records is None:
+                    break
+                try:
+                    stored_tx_count = self.write_records(records, connection)
+                except Exception as exc:
+                    if not self.quiet:
+                        print(exc)
+                    continue
+                with self._lock:
+                    self.stored_tx += stored_tx_count
+        finally:
+            connection.close()
+
+    def run_worker(self, worker, in_queue, *args):
+        """Run a pipeline worker, recording any error that stops it.
+
+        A failed worker keeps draining its input queue until it receives
+        its shutdown sentinel, so upstream stages never block on it.
+
+        """
+        try:
+            worker(*args)
+        except Exception as exc:
+            with self._lock:
+                self.worker_errors.append(exc)
+            if not self.quiet:
+                print(worker.__name__, "failed:", exc)
+            if in_queue is not None:
+                while in_queue.get() is not None:
+                    pass
+
     def rippled_history(self):
+        """Download transactions from rippled into ripple_ledger.
+
+        Ingest runs as three concurrent stages connected by bounded queues:
+        fetchers read ledgers and transactions from rippled, parsers extract
+        trade records, and writers insert them into Postgres.  When a queue
+        is full the stage feeding it blocks, so the slowest resource stays
+        busy without the others running ahead of it.  Queue depth metrics
+        are collected in self.queue_stats.
+
+        """
         if self.rippled_connect():
             self.get_current_index()
             if not self.full:
                 self.find_target_ledger()
+            if self.start_date is not None or self.end_date is not None:
+                self.find_date_range()
+            self.socket.close()
             if not self.quiet:
-                print("Reading from ledger", self.ledger_current_index, "to", self.halt)
+                print("Reading from ledger", self.ledger_current_index - 1, "to", self.halt)
             self.ledgers_to_read = self.ledger_current_index - self.halt
             self.ledger_index = self.ledger_current_index - 1
+            self.ledgers_read = 0
             self.stored_tx = 0
-            while self.ledger_index >= self.halt:
-                try:
-                    ledger = self.read_next_ledger()
-                    if not self.quiet:
-                        ledgers_read = self.ledger_current_index - self.ledger_index - 1
-                        progress = round(float(ledgers_read) / float(self.ledgers_to_read), 3)
-                        sys.stdout.write("Read " + str(ledgers_read) + "/" +\
-                                         str(self.ledgers_to_read) + " [" +\
-                                         str(progress * 100) + "%] ledgers (" +\
-                                         str(self.stored_tx) + " transactions)\r")
-                        sys.stdout.flush()
-                    if ledger is not None:
-                        tx_hash_list, accepted = self.parse_ledger(ledger)
-                        if tx_hash_list is not None:
-                            for tx_hash in tx_hash_list:
-                                if not self.full and self.ledger_index == self.halt:
-                                    if self.is_duplicate(tx_hash):
-                                        continue
-                                tx_data_result, options = self.get_tx(tx_hash, ledger)
-                                if tx_data_result:
-                                    self.stored_tx += self.parse_tx(tx_data_result,
-                                                                    accepted,
-                                                                    **options)
-                    self.ledger_index -= 1
-                except Exception as exc:
-                    print(exc)
-            self.socket.close()
-            if not self.quiet: print()
+            self.queue_stats = {}
+            self.worker_errors = []
+            for cache in (self.market_ids, self.issuer_ids, self.account_ids):
+                cache.load()
+            tx_queue = queue.Queue(maxsize=self.queue_size)
+            record_queue = queue.Queue(maxsize=self.queue_size)
+            connections = []
+            try:
+                for i in range(self.write_workers):
+                    connection = db.connect(POSTGRES_CONNECTION_STRING)
+                    connections.append(connection)
+                    connection.set_isolation_level(ext.ISOLATION_LEVEL_READ_COMMITTED)
+            except Exception:
+                for connection in connections:
+                    connection.close()
+                raise
+            fetchers = [spawn(self.run_worker, self.fetch_worker, None,
+                              tx_queue)
+                        for i in range(self.fetch_workers)]
+            parsers = [spawn(self.run_worker, self.parse_worker, tx_queue,
+                             tx_queue, record_queue)
+                       for i in range(self.parse_workers)]
+            writers = [spawn(self.run_worker, self.write_worker, record_queue,
+                             record_queue, connection)
+                       for connection in connections]
+
+            # Shut down each stage once everything upstream has finished
+            for upstream, downstream, q in ((fetchers, parsers, tx_queue),
+                                            (parsers, writers, record_queue)):
+                for thread in upstream:
+                    thread.join()
+                for thread in downstream:
+                    q.put(None)
+            for thread in writers:
+                thread.join()
+            if self.ledger_index >= self.halt:
+                self.worker_errors.append(IOError(
+                    "ledgers %d to %d were not fetched: no fetcher could "
+                    "connect to rippled" % (self.ledger_index, self.halt)))
+            self.flush_market_summary()
+            if not self.quiet:
+                print()
+                for name, stats in sorted(self.queue_stats.items()):
+                    print("Queue", name + ":", stats['puts'], "puts,",
+                          stats['blocked'], "blocked, depth max",
+                          stats['max_depth'], "mean",
+                          round(stats['mean_depth'], 1))
+            if self.worker_errors:
+                raise RuntimeError("ingest failed: " + "; ".join(
+                    str(exc) for exc in self.worker_errors))
             return True
         return False
 
+    def compact(self, ledgers_per_file=100000):
+        """Move cold raw trades out of ripple_ledger into archive files.
+
+        Trades more than retention_days older than the newest trade are
+        written, one file per range of ledgers_per_file ledgers, to
+        compressed columnar archives in archive_dir and deleted from
+        ripple_ledger.  Each archive is recorded in the ledger_archive table.
+        If resampling is enabled, only trades older than the last resampled
+        bar are archived, so their bars stay in resampled_ledger.
+
+        Args:
+          ledgers_per_file (int): Ledger range covered by each archive file.
+
+        Returns:
+          Number of trades archived.
+
+        """
+        with cursor() as cur:
+            cur.execute("SELECT max(txdate) FROM ripple_ledger")
+            newest = cur.fetchone()[0]
+            if newest is None:
+                return 0
+            cutoff = newest - self.retention_days * 86400
+            if self.resampling_frequencies is not None:
+                cur.execute("SELECT max(starttime) FROM resampled_ledger")
+                last_resample = cur.fetchone()[0]
+                if last_resample is None:
+                    return 0
+                cutoff = min(cutoff, last_resample)
+            cur.execute(
+                "SELECT min(ledgerindex), max(ledgerindex) FROM ripple_ledger "
+                "WHERE txdate < %s",
+                (cutoff,)
+            )
+            first_ledger, last_ledger = cur.fetchone()
+        if first_ledger is None:
+            return 0
+        if not os.path.isdir(self.archive_dir):
+            os.makedirs(self.archive_dir)
+        archived = 0
+        for lo in range(first_ledger, last_ledger + 1, ledgers_per_file):
+            hi = min(lo + ledgers_per_file - 1, last_ledger)
+            query = TRADES_QUERY + (
+                " WHERE r.txdate < %s AND r.ledgerindex BETWEEN %s AND %s "
+                "ORDER BY r.ledgerindex, r.txid"
+            )
+            df = read_trades(query, conn, params=(cutoff, lo, hi))
+            if df.empty:
+                continue
+            path = archive_path(self.archive_dir, df.ledgerindex.min(),
+                                df.ledgerindex.max())
+            write_archive(path, df)
+            with cursor() as cur:
+                cur.execute(
+                    "INSERT INTO ledger_archive "
+                    "(path, firstledger, lastledger, firsttxdate, lasttxdate, rows) "
+                    "VALUES (%s, %s, %s, %s, %s, %s)",
+                    (path, int(df.ledgerindex.min()), int(df.ledgerindex.max()),
+                     int(df.txdate.min()), int(df.txdate.max()), len(df))
+                )
+                cur.execute(
+                    "DELETE FROM ripple_ledger "
+                    "WHERE txdate < %s AND ledgerindex BETWEEN %s AND %s",
+                    (cutoff, lo, hi)
+                )
+            archived += len(df)
+            if not self.quiet:
+                print("Archived", len(df), "trades to", path)
+        return archived
+
+    def trades(self, currency1=None, currency2=None, start=None, end=None):
+        """Raw trades, including those moved to the archive.
+
+        Hot trades are read from ripple_ledger; archive files are only read
+        if their time range overlaps the request.
+
+        Args:
+          currency1 (str): Only include trades with this base currency.
+          currency2 (str): Only include trades with this quote currency.
+          start (str, datetime or int): Earliest trade date.
+          end (str, datetime or int): Only include trades before this date.
+
+        Returns:
+          pandas DataFrame of trades, sorted by txdate.
+
+        """
+        conditions, params = [], []
+        if currency1 is not None:
+            conditions.append("r.currency1 = %s")
+            params.append(currency1)
+        if currency2 is not None:
+            conditions.append("r.currency2 = %s")
+            params.append(currency2)
+        if start is not None:
+            start = to_timestamp(start)
+            conditions.append("r.txdate >= %s")
+            params.append(start)
+        if end is not None:
+            end = to_timestamp(end)
+            conditions.append("r.txdate < %s")
+            params.append(end)
+        query = TRADES_QUERY
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        frames = [read_trades(query, conn, params=params)]
+        with cursor() as cur:
+            cur.execute(
+                "SELECT path FROM ledger_archive "
+                "WHERE (%s IS NULL OR lasttxdate >= %s) "
+                "AND (%s IS NULL OR firsttxdate < %s) "
+                "ORDER BY firstledger",
+                (start, start, end, end)
+            )
+            paths = [row[0] for row in cur]
+        for path in paths:
+            df = read_archive(path)
+            if currency1 is not None:
+                df = df[df.currency1 == currency1]
+            if currency2 is not None:
+                df = df[df.currency2 == currency2]
+            if start is not None:
+                df = df[df.txdate >= start]
+            if end is not None:
+                df = df[df.txdate < end]
+            frames.append(df)
+        df = pd.concat(frames, ignore_index=True)
+        order = np.argsort(df.txdate.values, kind='mergesort')
+        return df.iloc[order].reset_index(drop=True)
+
     def download(self):
         """
         Walk from the current ledger index to the genesis ledger index,
@@ -538,24 +1290,262 @@ class Grapple(object):
         if self.resampling_frequencies is not None:
             self.find_markets()
             self.resample_time_series()
+        if self.retention_days is not None:
+            self.compact()
+
+
+class MarketWindow(object):
+    """Rolling trade window for a single market.
+
+    Trades can arrive in any order (the ledger is read backwards), so the
+    window is anchored at the newest trade seen rather than at the latest
+    arrival.  Trades in the window are kept in a heap ordered by date, and
+    the volume and VWAP sums are updated as trades enter and leave it.
+
+    """
+    def __init__(self, window=86400):
+        self.window = window
+        self.trades = []
+        self.last_txdate = None
+        self.last_price1 = None
+        self.last_price2 = None
+        self.trade_count = 0
+        self.volume1 = Decimal(0)
+        self.volume2 = Decimal(0)
+        self.notional1 = Decimal(0)
+        self.notional2 = Decimal(0)
+
+    def add(self, record):
+        self.trade_count += 1
+        txdate = record['txdate']
+        if txdate is None:
+            return
+        advanced = self.last_txdate is None or txdate > self.last_txdate
+        if advanced or txdate == self.last_txdate:
+            self.last_txdate = txdate
+            self.last_price1 = record['price1']
+            self.last_price2 = record['price2']
+        if txdate > self.last_txdate - self.window:
+            heapq.heappush(self.trades, (txdate, record['price1'],
+                                         record['amount1'], record['price2'],
+                                         record['amount2']))
+            self.volume1 += record['amount1']
+            self.volume2 += record['amount2']
+            self.notional1 += record['price1'] * record['amount1']
+            self.notional2 += record['price2'] * record['amount2']
+        if advanced:
+            self.expire()
+
+    def expire(self):
+        cutoff = self.last_txdate - self.window
+        while self.trades and self.trades[0][0] <= cutoff:
+            txdate, price1, amount1, price2, amount2 = heapq.heappop(self.trades)
+            self.volume1 -= amount1
+            self.volume2 -= amount2
+            self.notional1 -= price1 * amount1
+            self.notional2 -= price2 * amount2
+
+    def row(self, market):
+        quantum = Decimal('.00000001')
+        vwap1, vwap2 = None, None
+        if self.volume1:
+            vwap1 = (self.notional1 / self.volume1).quantize(quantum)
+        if self.volume2:
+            vwap2 = (self.notional2 / self.volume2).quantize(quantum)
+        return {
+            'currency1': market[0],
+            'currency2': market[1],
+            'lasttxdate': self.last_txdate,
+            'lastprice1': self.last_price1,
+            'lastprice2': self.last_price2,
+            'volume1': self.volume1,
+            'volume2': self.volume2,
+            'vwap1': vwap1,
+            'vwap2': vwap2,
+            'windowtrades': len(self.trades),
+            'tradecount': self.trade_count,
+        }
+
+
+class InternCache(object):
+    """In-process cache of dimension table surrogate keys.
+
+    Maps natural keys (addresses, currency pairs) to the integer ids used
+    in ripple_ledger.  Cache hits need no database round-trip; misses look
+    up the key and insert it if it is new.  Keys are tuples of the table's
+    key columns, or a bare value for single-column tables.
+
+    """
+    def __init__(self, table, id_column, columns):
+        self.table = table
+        self.id_column = id_column
+        self.columns = columns
+        self.ids = {}
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            self.ids = {}
+
+    def load(self):
+        """Preload every key in the dimension table."""
+        query = "SELECT %s, %s FROM %s" % (self.id_column,
+                                           ", ".join(self.columns), self.table)
+        with cursor() as cur:
+            cur.execute(query)
+            with self._lock:
+                for row in cur:
+                    self.ids[self.key(row[1:])] = row[0]
+
+    def key(self, values):
+        return values[0] if len(self.columns) == 1 else tuple(values)
+
+    def resolve(self, key, connection=None):
+        """Surrogate id for key, inserting a new dimension row if needed.
+
+        New rows are committed on the given connection before their ids
+        are cached, so the cache never holds an id that was rolled back.
+
+        """
+        if key is None:
+            return None
+        surrogate = self.ids.get(key)
+        if surrogate is not None:
+            return surrogate
+        with self._lock:
+            if key in self.ids:
+                return self.ids[key]
+            values = (key,) if len(self.columns) == 1 else tuple(key)
+            condition = " AND ".join(c + " = %s" for c in self.columns)
+            select = "SELECT %s FROM %s WHERE %s" % (self.id_column,
+                                                     self.table, condition)
+            insert = "INSERT INTO %s (%s) VALUES (%s) RETURNING %s" % (
+                self.table, ", ".join(self.columns),
+                ", ".join(["%s"] * len(self.columns)), self.id_column)
+            with cursor(connection) as cur:
+                cur.execute(select, values)
+                row = cur.fetchone()
+                if row is None:
+                    cur.execute(insert, values)
+                    row = cur.fetchone()
+            self.ids[key] = row[0]
+            return row[0]
 
 
 @contextmanager
-def cursor():
-    """Database cursor generator. Commit on context exit."""
+def cursor(connection=None):
+    """Database cursor generator. Commit on context exit.
+
+    Uses the module-level connection unless another one is given.
+
+    """
+    if connection is None:
+        connection = conn
+    cur = connection.cursor()
     try:
-        cur = conn.cursor()
         yield cur
     except (db.Error, Exception) as e:
         cur.close()
-        if conn:
-            conn.rollback()
-        print(e.message)
+        if connection:
+            connection.rollback()
+        print(e)
         raise
     else:
-        conn.commit()
+        connection.commit()
         cur.close()
 
+def close_socket(socket):
+    """Close a websocket, ignoring errors from one that is already dead."""
+    try:
+        socket.close()
+    except Exception:
+        pass
+
+def spawn(target, *args):
+    """Start a daemon thread running target(*args)."""
+    thread = threading.Thread(target=target, args=args)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+def encode_txhash(tx_hash):
+    """Pack a hex transaction hash into 32 bytes for a bytea column."""
+    if tx_hash is None:
+        return None
+    packed = binascii.unhexlify(tx_hash)
+    if len(packed) != 32:
+        raise ValueError("transaction hash must be 32 bytes: %s" % tx_hash)
+    return db.Binary(packed)
+
+def read_trades(query, connection, params=None):
+    """Run a trades query, keeping numeric columns as Decimals."""
+    return psql.frame_query(query, connection, coerce_float=False,
+                            params=params)
+
+def archive_path(archive_dir, first_ledger, last_ledger):
+    """Unused absolute archive file path for a ledger range.
+
+    Paths are absolute so that ledger_archive entries stay valid whatever
+    the working directory of a later run.
+
+    """
+    archive_dir = os.path.abspath(archive_dir)
+    name = "ripple_ledger_%d_%d" % (first_ledger, last_ledger)
+    path = os.path.join(archive_dir, name + ".npz")
+    suffix = 1
+    while os.path.exists(path):
+        path = os.path.join(archive_dir, "%s_%d.npz" % (name, suffix))
+        suffix += 1
+    return path
+
+def write_archive(path, df):
+    """Save trades to a compressed columnar archive.
+
+    Each column is stored as its own compressed array.  Amounts and prices
+    are kept as decimal strings so no precision is lost.  NULLs are stored
+    as -1 in integer columns (accepted is an int8 column) and as empty
+    strings in text columns.
+
+    """
+    columns = {}
+    for name in ARCHIVE_COLUMNS:
+        if name in ARCHIVE_INTEGER_COLUMNS:
+            values = [-1 if pd.isnull(v) else int(v) for v in df[name]]
+            columns[name] = np.array(values, dtype=np.int64)
+        elif name == 'accepted':
+            values = [-1 if pd.isnull(v) else int(bool(v)) for v in df[name]]
+            columns[name] = np.array(values, dtype=np.int8)
+        else:
+            values = ['' if pd.isnull(v) else str(v) for v in df[name]]
+            columns[name] = np.array(values, dtype=np.str_)
+    np.savez_compressed(path, **columns)
+
+def read_archive(path):
+    """Load trades saved by write_archive."""
+    data = np.load(path)
+    try:
+        columns = {}
+        for name in ARCHIVE_COLUMNS:
+            values = data[name].tolist()
+            if name in ARCHIVE_INTEGER_COLUMNS:
+                values = [None if v == -1 else v for v in values]
+            elif name in ARCHIVE_DECIMAL_COLUMNS:
+                values = [Decimal(v) if v else None for v in values]
+            elif name == 'accepted':
+                values = [None if v == -1 else bool(v) for v in values]
+            else:
+                values = [v or None for v in values]
+            columns[name] = values
+    finally:
+        data.close()
+    return pd.DataFrame(columns, columns=ARCHIVE_COLUMNS)
+
+def to_timestamp(date):
+    """Unix timestamp from a date string, datetime or timestamp."""
+    if isinstance(date, numbers.Real):
+        return int(date)
+    return int(pd.Timestamp(date).value // 10**9)
+
 def currency_precision(currency_code):
     if currency_code.upper() == 'NXT':
         precision = '.01'
@@ -569,8 +1559,10 @@ def main(argv=None):
     if argv is None:
         argv = sys.argv
     try:
-        short_opts = 'hpfqw:g:'
-        long_opts = ['help', 'public', 'full', 'quiet', 'websocket=', 'genesis=']
+        short_opts = 'hpfqw:g:s:e:r:'
+        long_opts = ['help', 'public', 'full', 'quiet', 'websocket=', 'genesis=',
+                     'start-date=', 'end-date=', 'retention=',
+                     'fetchers=', 'parsers=', 'writers=']
         opts, vals = getopt.getopt(argv[1:], short_opts, long_opts)
     except getopt.GetoptError as e:
         sys.stderr.write(e.msg)
@@ -595,6 +1587,18 @@ def main(argv=None):
             parameters['socket_url'] = arg
         elif opt in ('-g', '--genesis'):
             parameters['genesis'] = int(arg)
+        elif opt in ('-s', '--start-date'):
+            parameters['start_date'] = arg
+        elif opt in ('-e', '--end-date'):
+            parameters['end_date'] = arg
+        elif opt in ('-r', '--retention'):
+            parameters['retention_days'] = int(arg)
+        elif opt == '--fetchers':
+            parameters['fetch_workers'] = int(arg)
+        elif opt == '--parsers':
+            parameters['parse_workers'] = int(arg)
+        elif opt == '--writers':
+            parameters['write_workers'] = int(arg)
     
     Grapple(**parameters).download()
 
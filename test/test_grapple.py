@@ -18,10 +18,15 @@ try:
 except:
     pass
 import os
+import shutil
+import tempfile
 import platform
+from datetime import datetime
 from decimal import Decimal, getcontext, ROUND_HALF_EVEN
+import pandas as pd
 import psycopg2 as db
 import psycopg2.extensions as ext
+from six.moves import queue
 
 if platform.python_version() < "2.7":
     unittest = __import__("unittest2")
@@ -31,7 +36,10 @@ else:
 HERE = os.path.dirname(os.path.realpath(__file__))
 sys.path.insert(0, os.path.join(HERE, os.pardir, "grapple"))
 
-from grapple import Grapple
+from grapple import Grapple, MarketWindow, InternCache, to_timestamp
+from grapple import encode_txhash
+from grapple import ARCHIVE_COLUMNS, TRADES_QUERY
+from grapple import read_trades, archive_path, write_archive, read_archive
 
 class TestGrapple(unittest.TestCase):
 
@@ -54,6 +62,274 @@ class TestGrapple(unittest.TestCase):
         self.grapple = Grapple(resampling_frequencies=('8T', '12T'))
         self.assertEqual(self.grapple.resampling_frequencies, ('8T', '12T'))
 
+    def test_init_pipeline(self):
+        self.grapple = Grapple(fetch_workers=4, parse_workers=2,
+                               write_workers=3, queue_size=50)
+        self.assertEqual(self.grapple.fetch_workers, 4)
+        self.assertEqual(self.grapple.parse_workers, 2)
+        self.assertEqual(self.grapple.write_workers, 3)
+        self.assertEqual(self.grapple.queue_size, 50)
+
+    def test_init_pipeline_invalid(self):
+        for option in ('fetch_workers', 'parse_workers', 'write_workers',
+                       'queue_size'):
+            with self.assertRaises(ValueError):
+                Grapple(**{option: 0})
+
+    def test_next_ledger_index(self):
+        self.grapple.halt = 10
+        self.grapple.ledger_index = 11
+        self.assertEqual(self.grapple.next_ledger_index(), 11)
+        self.assertEqual(self.grapple.next_ledger_index(), 10)
+        self.assertIsNone(self.grapple.next_ledger_index())
+
+    def test_enqueue(self):
+        q = queue.Queue(maxsize=2)
+        self.grapple.enqueue('tx', q, 1)
+        self.grapple.enqueue('tx', q, 2)
+        stats = self.grapple.queue_stats['tx']
+        self.assertEqual(stats['puts'], 2)
+        self.assertEqual(stats['blocked'], 0)
+        self.assertEqual(stats['max_depth'], 2)
+        self.assertEqual(stats['mean_depth'], 1.5)
+
+    def test_run_worker(self):
+        def worker(q):
+            raise ValueError("writer failed")
+        q = queue.Queue()
+        q.put(['record'])
+        q.put(None)
+        self.grapple.run_worker(worker, q, q)
+        self.assertEqual(len(self.grapple.worker_errors), 1)
+        self.assertTrue(q.empty())
+
+    def test_fetch_worker_retry(self):
+        class LedgerSocket(object):
+            def __init__(self, broken):
+                self.broken = broken
+            def send(self, message):
+                if self.broken:
+                    raise IOError("connection dropped")
+            def recv(self):
+                return '{"result": {"ledger": {"transactions": []}}}'
+            def close(self):
+                pass
+        sockets = [LedgerSocket(False), LedgerSocket(True)]
+        self.grapple.open_socket = lambda: sockets.pop()
+        self.grapple.halt = 10
+        self.grapple.ledger_index = 11
+        self.grapple.ledgers_to_read = 2
+        self.grapple.ledgers_read = 0
+        self.grapple.fetch_worker(queue.Queue())
+        self.assertEqual(sockets, [])
+        self.assertEqual(self.grapple.ledgers_read, 2)
+        self.assertEqual(self.grapple.worker_errors, [])
+
+    def test_market_window(self):
+        window = MarketWindow(window=100)
+        trades = ((1000, '2', '10'), (950, '4', '10'), (890, '8', '10'),
+                  (1080, '3', '20'))
+        for txdate, price, amount in trades:
+            window.add({
+                'txdate': txdate,
+                'price1': Decimal(price),
+                'amount1': Decimal(amount),
+                'price2': 1 / Decimal(price),
+                'amount2': Decimal(amount) * Decimal(price),
+            })
+        row = window.row(('XRP', 'USD'))
+        self.assertEqual(row['lasttxdate'], 1080)
+        self.assertEqual(row['lastprice1'], Decimal('3'))
+        self.assertEqual(row['volume1'], Decimal('30'))
+        self.assertEqual(row['vwap1'], Decimal('2.66666667'))
+        self.assertEqual(row['windowtrades'], 2)
+        self.assertEqual(row['tradecount'], 4)
+
+    def test_intern_cache(self):
+        markets = InternCache("ledger_markets", "marketid",
+                              ("currency1", "currency2"))
+        markets.ids[("XRP", "USD")] = 7
+        self.assertEqual(markets.resolve(("XRP", "USD")), 7)
+        self.assertEqual(markets.key(("BTC", "XRP")), ("BTC", "XRP"))
+        issuers = InternCache("ledger_issuers", "issuerid", ("address",))
+        self.assertEqual(issuers.key(("rLvcQ6ctvr12aQq29AcZT6JMWH7iZ8esHS",)),
+                         "rLvcQ6ctvr12aQq29AcZT6JMWH7iZ8esHS")
+        self.assertIsNone(issuers.resolve(None))
+
+    def test_init_date_range(self):
+        self.grapple = Grapple(start_date="2015-01-01", end_date="2015-02-01")
+        self.assertEqual(self.grapple.start_date, "2015-01-01")
+        self.assertEqual(self.grapple.end_date, "2015-02-01")
+
+    def test_to_timestamp(self):
+        self.assertEqual(to_timestamp("2015-01-01"), 1420070400)
+        self.assertEqual(to_timestamp(datetime(2015, 1, 1)), 1420070400)
+        self.assertEqual(to_timestamp(1420070400), 1420070400)
+
+    def test_find_ledger_index(self):
+        self.grapple.close_times = dict((i, 1000 + 10*i) for i in range(101))
+        self.assertEqual(self.grapple.find_ledger_index(1500, 0, 100), 50)
+        self.assertEqual(self.grapple.find_ledger_index(1505, 0, 100), 51)
+        self.assertEqual(self.grapple.find_ledger_index(0, 20, 100), 20)
+        self.assertEqual(self.grapple.find_ledger_index(9999, 0, 100), 101)
+
+    def test_init_retention(self):
+        self.grapple = Grapple(retention_days=30, archive_dir="cold")
+        self.assertEqual(self.grapple.retention_days, 30)
+        self.assertEqual(self.grapple.archive_dir, "cold")
+
+    def test_archive_roundtrip(self):
+        df = pd.DataFrame({
+            'txid': [3, 5],
+            'txhash': [self.txhash, self.txhash],
+            'currency1': ['XRP', 'USD'],
+            'currency2': ['USD', 'XRP'],
+            'amount1': [Decimal('1.000001'), Decimal('12.50000000')],
+            'amount2': [Decimal('0.00500000'), Decimal('2500.000000')],
+            'price1': [Decimal('0.00500000'), Decimal('200.000000')],
+            'price2': [Decimal('200.00000000'), Decimal('0.00500000')],
+            'issuer1': [None, 'rvYAfWj5gh67oV6fW32ZzP3Aw4Eubs59B'],
+            'issuer2': ['rvYAfWj5gh67oV6fW32ZzP3Aw4Eubs59B', None],
+            'account1': ['rLvcQ6ctvr12aQq29AcZT6JMWH7iZ8esHS'] * 2,
+            'txdate': [1420070400, 1420070410],
+            'ledgerindex': [10000000, 10000002],
+            'accepted': [True, None],
+        })
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "archive.npz")
+            write_archive(path, df)
+            archived = read_archive(path)
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertEqual(list(archived.columns), list(ARCHIVE_COLUMNS))
+        for name in ARCHIVE_COLUMNS:
+            self.assertEqual(list(archived[name]), list(df[name]))
+
+    def test_encode_txhash(self):
+        self.assertIsNone(encode_txhash(None))
+        self.assertIsNotNone(encode_txhash(self.txhash))
+        with self.assertRaises(ValueError):
+            encode_txhash(self.txhash[:-2])
+
+    def test_intern_cache_rollback(self):
+        class FailingCursor(object):
+            def execute(self, query, params=None):
+                if query.startswith("INSERT"):
+                    raise db.OperationalError("insert failed")
+            def fetchone(self):
+                return None
+            def close(self):
+                pass
+        class FailingConnection(object):
+            def cursor(self):
+                return FailingCursor()
+            def rollback(self):
+                pass
+        issuers = InternCache("ledger_issuers", "issuerid", ("address",))
+        with self.assertRaises(db.OperationalError):
+            issuers.resolve("rvYAfWj5gh67oV6fW32ZzP3Aw4Eubs59B",
+                            FailingConnection())
+        self.assertEqual(issuers.ids, {})
+
+    def test_reset_market_summary(self):
+        self.grapple.market_windows[('XRP', 'USD')] = MarketWindow()
+        self.grapple.summary_pending.add(('XRP', 'USD'))
+        self.grapple.summary_updates = 5
+        self.grapple.reset_market_summary()
+        self.assertEqual(self.grapple.market_windows, {})
+        self.assertEqual(self.grapple.summary_pending, set())
+        self.assertEqual(self.grapple.summary_updates, 0)
+
+    def test_flush_market_summary_failure(self):
+        class BrokenConnection(object):
+            def cursor(self):
+                raise db.OperationalError("connection lost")
+            def rollback(self):
+                pass
+        window = MarketWindow()
+        window.add({'txdate': 1000, 'price1': Decimal('2'),
+                    'amount1': Decimal('1'), 'price2': Decimal('.5'),
+                    'amount2': Decimal('2')})
+        self.grapple.market_windows[('XRP', 'USD')] = window
+        self.grapple.summary_pending.add(('XRP', 'USD'))
+        self.grapple.flush_market_summary(BrokenConnection())
+        self.assertEqual(self.grapple.summary_pending, set([('XRP', 'USD')]))
+
+    def test_get_close_time_socket_error(self):
+        class BrokenSocket(object):
+            def send(self, message):
+                raise IOError("socket closed")
+            def close(self):
+                pass
+        self.grapple.socket = BrokenSocket()
+        self.grapple.open_socket = BrokenSocket
+        with self.assertRaises(IOError):
+            self.grapple.get_close_time(8642812)
+        self.assertNotIn(8642812, self.grapple.close_times)
+        self.grapple.socket = None
+
+    def test_get_close_time_not_found(self):
+        class NotFoundSocket(object):
+            def send(self, message):
+                pass
+            def recv(self):
+                return '{"status": "error", "error": "lgrNotFound"}'
+        self.grapple.socket = NotFoundSocket()
+        self.assertIsNone(self.grapple.get_close_time(8642812))
+        self.grapple.socket = None
+
+    def test_archive_roundtrip_from_query(self):
+        class TradesCursor(object):
+            description = [(name,) for name in ARCHIVE_COLUMNS]
+            rows = [(3, self.txhash, 'USD', 'XRP',
+                     Decimal('1234567890123456.12345678'),
+                     Decimal('0.00000001'), Decimal('0.00000001'),
+                     Decimal('9876543210987654.87654321'),
+                     'rvYAfWj5gh67oV6fW32ZzP3Aw4Eubs59B', None,
+                     'rLvcQ6ctvr12aQq29AcZT6JMWH7iZ8esHS',
+                     1420070400, 10000000, True)]
+            def execute(self, query, params=None):
+                pass
+            def fetchall(self):
+                return self.rows
+            def close(self):
+                pass
+        class TradesConnection(object):
+            def cursor(self):
+                return TradesCursor()
+            def commit(self):
+                pass
+        df = read_trades(TRADES_QUERY, TradesConnection(), params=())
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "archive.npz")
+            write_archive(path, df)
+            archived = read_archive(path)
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertEqual(archived.amount1[0], Decimal('1234567890123456.12345678'))
+        self.assertEqual(archived.price2[0], Decimal('9876543210987654.87654321'))
+        self.assertEqual(archived.amount2[0], Decimal('0.00000001'))
+
+    def test_archive_path(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = archive_path(tmpdir, 100, 200)
+            self.assertEqual(os.path.basename(path), "ripple_ledger_100_200.npz")
+            open(path, 'w').close()
+            path = archive_path(tmpdir, 100, 200)
+            self.assertEqual(os.path.basename(path), "ripple_ledger_100_200_1.npz")
+            cwd = os.getcwd()
+            os.chdir(tmpdir)
+            try:
+                path = archive_path(".", 100, 200)
+            finally:
+                os.chdir(cwd)
+            self.assertTrue(os.path.isabs(path))
+        finally:
+            shutil.rmtree(tmpdir)
+
     def test_rippled_connect(self):
         self.assertIsNone(self.grapple.socket)
         self.grapple.rippled_connect()